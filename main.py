@@ -1,26 +1,37 @@
 import os
-import email
+from email import policy
+from email.parser import BytesParser
+from email.utils import parseaddr
 import re
 import imaplib2
-from email.header import decode_header
 import anthropic
 from google.oauth2 import service_account
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import AuthorizedSession
 import gspread
-import tempfile
 import smtplib
+import io
+import html
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 import logging
 import datetime
+import base64
+import hashlib
 import json
-import PyPDF2
-import docx
+import math
 import csv
+import zipfile
+from xml.etree import ElementTree
 import time
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 
 # Set up logging
@@ -29,6 +40,187 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Maximum number of messages requested in a single IMAP FETCH command. Larger
+# message sets risk tripping server-side command length limits.
+IMAP_FETCH_BATCH_SIZE = 100
+
+# UID of a message in a UID FETCH response, e.g. b"12 (UID 3456 BODY[] {789}",
+# or b" UID 3456)" after the message data
+FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+
+# Parts of an IMAP BODYSTRUCTURE that may hold an invoice: a document, image or
+# forwarded email, or any part sent as an attachment
+BODYSTRUCTURE_ATTACHMENT_RE = re.compile(
+    rb'\("(?:APPLICATION|IMAGE|MESSAGE)" "|\("ATTACHMENT" ', re.IGNORECASE
+)
+
+# Number of fetched emails parsed at the same time. Parsing downloads any PDFs
+# linked from the email, so this mostly overlaps those downloads.
+EMAIL_PARSE_MAX_WORKERS = 8
+
+# PDFs with at least this many pages have their text extracted by the shared
+# pool of worker processes, which has up to PDF_MAX_WORKERS workers. Smaller
+# PDFs aren't worth sending to another process.
+PDF_PARALLEL_MIN_PAGES = 32
+PDF_MAX_WORKERS = 4
+
+# Default limit on the extracted text of each attachment sent to Anthropic
+MAX_ATTACHMENT_CHARS = 50_000
+
+# Polling interval bounds, in seconds, while waiting for a Message Batch
+BATCH_POLL_INITIAL_DELAY = 5
+BATCH_POLL_MAX_DELAY = 300
+
+# Attempts at each Message Batches API call when it fails with a connection,
+# rate limit or server error
+BATCH_API_MAX_ATTEMPTS = 5
+
+# WordprocessingML tags for paragraphs, runs of text, tabs and line breaks in a
+# .docx document
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_PARAGRAPH_TAG = f"{DOCX_NAMESPACE}p"
+DOCX_TEXT_TAG = f"{DOCX_NAMESPACE}t"
+DOCX_TAB_TAG = f"{DOCX_NAMESPACE}tab"
+DOCX_BREAK_TAGS = {f"{DOCX_NAMESPACE}br", f"{DOCX_NAMESPACE}cr"}
+
+# Attachment types whose text extraction is slow enough to be worth a worker
+# process when an email has several of them
+SLOW_EXTRACTION_TYPES = {"application/pdf"}
+
+# Image types Anthropic accepts as image content blocks, and the largest image
+# sent (about 5MB once base64 encoded, the API limit). Larger or other images
+# are only mentioned by name in the prompt.
+NATIVE_IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+MAX_NATIVE_IMAGE_BYTES = 3_750_000
+
+# Anthropic rejects PDFs with more than 100 pages, and requests over 32MB. PDFs
+# over the page limit, and attachments that would take the request over the
+# size limit once base64 encoded, have their text extracted locally instead.
+MAX_NATIVE_PDF_PAGES = 100
+MAX_NATIVE_REQUEST_BYTES = 20_000_000
+
+# Page objects, and page counts in the page tree, of a PDF without object
+# streams. Used to count its pages without PyMuPDF.
+PDF_PAGE_RE = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+PDF_PAGE_COUNT_RE = re.compile(rb"/Count\s+(\d+)")
+
+# Words in an email body suggesting it is itself an invoice or statement
+INVOICE_BODY_TERMS = (
+    "invoice",
+    "statement",
+    "receipt",
+    "rent",
+    "tenancy",
+    "total due",
+    "amount due",
+)
+INVOICE_BODY_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, INVOICE_BODY_TERMS)) + r")\b",
+    re.IGNORECASE,
+)
+
+# Attachment types that may hold an invoice, used to decide whether an email
+# is worth analyzing when invoice_filter_pattern is set
+INVOICE_ATTACHMENT_TYPES = {
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "text/csv",
+} | NATIVE_IMAGE_TYPES
+
+# Patterns used to find links to invoice documents in email bodies
+HTML_DOCUMENT_LINK_RE = re.compile(
+    r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>([^<]*(?:\.pdf|invoice|statement|receipt|document)[^<]*)</a>',
+    re.IGNORECASE,
+)
+HREF_RE = re.compile(r'href=["\']([^"\']+)["\']', re.IGNORECASE)
+DOCUMENT_URL_KEYWORDS = (
+    "document",
+    "statement",
+    "invoice",
+    "receipt",
+    "download",
+    "file",
+    "attachment",
+)
+PDF_URL_RES = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r'https?://[^\s<>"]+\.pdf(?:\?[^\s<>"]*)?',  # URLs ending with .pdf
+        r'https?://[^\s<>"]*[/\?&]pdf[/\?&][^\s<>"]*',  # URLs with pdf in path
+        r'https?://[^\s<>"]*(?:document|statement|invoice|receipt|download|file|attachment)[^\s<>"]*',  # Document-related URLs
+    )
+]
+
+# Attempts made to append rows to the Google Sheet when rate limited (HTTP 429).
+SHEETS_MAX_ATTEMPTS = 4
+
+# Line item dates in the YYYY-MM-DD format requested from Claude
+ISO_DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+# Static extraction instructions sent with every email. Kept constant so the
+# prompt prefix is byte-identical across calls and can be served from
+# Anthropic's prompt cache.
+EXTRACTION_INSTRUCTIONS = """
+I need you to analyze emails and any attachments related to rental property invoices or statements.
+Extract line items and categorize them appropriately for accounting purposes.
+
+For each line item you identify, please provide:
+1. Date (in YYYY-MM-DD format)
+2. Description (what the charge or payment is for)
+3. Amount (negative for expenses, positive for income)
+4. Category (e.g., Utilities, Repairs, Rent)
+5. Property (if a specific property address is mentioned)
+
+Record the line items with the record_line_items tool. If there are no line
+items, call it with an empty list and explain why in the notes.
+"""
+
+# Tool used to get line items back as structured data rather than parsing JSON
+# out of free text.
+LINE_ITEMS_TOOL = {
+    "name": "record_line_items",
+    "description": "Record the line items extracted from an invoice or statement.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "line_items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "date": {
+                            "type": "string",
+                            "description": "Date in YYYY-MM-DD format",
+                        },
+                        "description": {
+                            "type": "string",
+                            "description": "What the charge or payment is for",
+                        },
+                        "amount": {
+                            "type": "number",
+                            "description": "Negative for expenses, positive for income",
+                        },
+                        "category": {
+                            "type": "string",
+                            "description": "Category, e.g. Utilities, Repairs, Rent",
+                        },
+                        "property": {
+                            "type": "string",
+                            "description": "Property address, or empty if not specified",
+                        },
+                    },
+                    "required": ["date", "description", "amount", "category"],
+                },
+            },
+            "notes": {
+                "type": "string",
+                "description": "Explanation of why no line items were found, if so",
+            },
+        },
+        "required": ["line_items"],
+    },
+}
+
 
 def load_config():
     """Load configuration from YAML file."""
@@ -43,6 +235,191 @@ def load_config():
         raise
 
 
+def read_pdf_pages(doc, start, stop, max_chars=None):
+    """
+    Return the text of the pages of an open PDF in the range [start, stop),
+    stopping early once more than max_chars characters have been read.
+    """
+    pages = []
+    text_length = 0
+    for page_num in range(start, stop):
+        if max_chars is not None and text_length > max_chars:
+            break
+        # sort=True orders text blocks top to bottom, then left to right, so
+        # multi-column invoices keep their rows together
+        page_text = doc[page_num].get_text(sort=True)
+        pages.append(page_text)
+        text_length += len(page_text)
+    return pages
+
+
+def count_pdf_pages(data):
+    """Return the number of pages in a PDF, or None if it can't be opened."""
+    # PDFs without object streams list their pages uncompressed, so they can
+    # be counted without loading PyMuPDF. Pages rewritten by incremental
+    # updates, or outline counts, can only overstate the number of pages,
+    # which at worst has the text extracted locally.
+    if b"/ObjStm" not in data:
+        page_count = max(
+            len(PDF_PAGE_RE.findall(data)),
+            max(map(int, PDF_PAGE_COUNT_RE.findall(data)), default=0),
+        )
+        if page_count:
+            return page_count
+
+    import pymupdf
+
+    try:
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            return doc.page_count
+    except Exception as e:
+        logger.warning(f"Could not count the pages of a PDF: {e}")
+        return None
+
+
+def extract_pdf_page_range(data, start, stop, max_chars=None):
+    """Extract the text of PDF pages in the range [start, stop)."""
+    import pymupdf
+
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        return read_pdf_pages(doc, start, stop, max_chars)
+
+
+def extract_pdf_pages_in_parallel(data, page_count, pool, max_chars=None):
+    """
+    Extract the text of every PDF page, split into contiguous page ranges across
+    the worker processes of pool. Each worker parses the PDF once for its whole
+    range, and stops once its range alone has more than max_chars characters.
+    """
+    workers = min(os.cpu_count() or 1, PDF_MAX_WORKERS)
+    pages_per_worker = -(-page_count // workers)
+    ranges = [
+        (start, min(start + pages_per_worker, page_count))
+        for start in range(0, page_count, pages_per_worker)
+    ]
+
+    futures = [
+        pool.submit(extract_pdf_page_range, data, start, stop, max_chars)
+        for start, stop in ranges
+    ]
+
+    pages = []
+    for (start, stop), future in zip(ranges, futures):
+        range_pages = future.result()
+        pages.extend(range_pages)
+        # Pages after a range that stopped early would leave a gap
+        if len(range_pages) < stop - start:
+            for remaining in futures:
+                remaining.cancel()
+            break
+    return pages
+
+
+def extract_docx_text(data, pool=None, max_chars=None):
+    """
+    Extract the text of a .docx file straight from its document XML, one line
+    per paragraph (including those in tables).
+    """
+    parts = []
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        with archive.open("word/document.xml") as document:
+            for _, element in ElementTree.iterparse(document):
+                if element.tag == DOCX_TEXT_TAG:
+                    parts.append(element.text or "")
+                elif element.tag == DOCX_TAB_TAG:
+                    # Tab stop definitions share the tag but have a w:val
+                    if element.get(f"{DOCX_NAMESPACE}val") is None:
+                        parts.append("\t")
+                elif element.tag in DOCX_BREAK_TAGS:
+                    parts.append("\n")
+                elif element.tag == DOCX_PARAGRAPH_TAG:
+                    parts.append("\n")
+                    element.clear()
+    return "".join(parts)
+
+
+def extract_pdf_text(data, pool=None, max_chars=None):
+    """
+    Extract the text of a PDF. Long PDFs are split across the worker processes
+    of pool, if given; workers themselves pass none. Once more than max_chars
+    characters have been read, the remaining pages are skipped.
+    """
+    # Imported here, like the other PyMuPDF helpers, so it is only loaded
+    # once a PDF needs it
+    import pymupdf
+
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        page_count = doc.page_count
+
+        if pool is not None and page_count >= PDF_PARALLEL_MIN_PAGES:
+            pages = extract_pdf_pages_in_parallel(data, page_count, pool, max_chars)
+        else:
+            pages = read_pdf_pages(doc, 0, page_count, max_chars)
+
+        # Images but no text on any page means a scanned document without a
+        # text layer. A scanned cover page alone doesn't, as later pages can
+        # still have text.
+        if not any(page_text.strip() for page_text in pages) and any(
+            page.get_images() for page in doc
+        ):
+            return "[Scanned PDF with no text layer]"
+
+    if len(pages) < page_count:
+        logger.info(
+            f"Stopped reading PDF after {len(pages)} of {page_count} pages, "
+            f"as it has more than {max_chars} characters"
+        )
+
+    return "".join(page_text + "\n\n" for page_text in pages)
+
+
+def extract_plain_text(data, pool=None, max_chars=None):
+    """Extract the text of a plain text file."""
+    return data.decode("utf-8", errors="replace")
+
+
+def extract_csv_text(data, pool=None, max_chars=None):
+    """Extract the text of a CSV file, one line per row."""
+    csv_reader = csv.reader(
+        io.StringIO(data.decode("utf-8", errors="replace"), newline="")
+    )
+    return "".join(", ".join(row) + "\n" for row in csv_reader)
+
+
+# Text extractors for each supported attachment MIME type. Each takes the
+# attachment data, a process pool and a character limit.
+ATTACHMENT_TEXT_EXTRACTORS = {
+    "application/pdf": extract_pdf_text,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": extract_docx_text,
+    "text/plain": extract_plain_text,
+    "text/csv": extract_csv_text,
+}
+
+
+def extract_text_from_attachment(data, mime_type, pool=None, max_chars=None):
+    """
+    Extract text from the raw bytes of various file types. pool and max_chars
+    are passed on to the extractor, which may ignore them.
+    """
+    try:
+        extractor = ATTACHMENT_TEXT_EXTRACTORS.get(mime_type)
+        if extractor:
+            return extractor(data, pool=pool, max_chars=max_chars)
+
+        if mime_type.startswith("image/"):
+            # For images, we can't extract text directly
+            return "[This is an image attachment]"
+
+        # For other file types
+        return f"[Attachment of type {mime_type}]"
+    except BrokenProcessPool:
+        # Left to the caller, which replaces the pool
+        raise
+    except Exception as e:
+        logger.error(f"Error extracting text from attachment: {e}")
+        return f"[Error extracting text: {str(e)}]"
+
+
 class InvoiceProcessor:
     def __init__(self):
         # Load configuration
@@ -53,19 +430,71 @@ class InvoiceProcessor:
             self.config["service_account_file"],
             scopes=["https://www.googleapis.com/auth/spreadsheets"],
         )
-        self.gc = gspread.authorize(self.credentials)
+        # All Sheets API calls share one keep-alive session and connection pool
+        self.sheets_session = AuthorizedSession(self.credentials)
+        self.sheets_session.mount(
+            "https://", HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        )
+        self.gc = gspread.Client(auth=self.credentials, session=self.sheets_session)
         self.spreadsheet = self.gc.open_by_key(self.config["spreadsheet_id"])
         self.worksheet = self.spreadsheet.worksheet(self.config["worksheet_name"])
+        # Rows are appended directly to the five line item columns. The title is
+        # quoted, with any quotes in it doubled.
+        self.append_range = gspread.utils.absolute_range_name(
+            self.worksheet.title, "A:E"
+        )
+
+        # Shared keep-alive session for other HTTP calls (linked PDF downloads
+        # and model discovery)
+        self.http_session = requests.Session()
+        self.http_session.mount("https://", HTTPAdapter(pool_maxsize=8))
 
-        # Set up Anthropic client
+        # Set up Anthropic client. Concurrent analyses share HTTP/2 connections.
         self.anthropic_client = anthropic.Anthropic(
-            api_key=self.config["anthropic_api_key"]
+            api_key=self.config["anthropic_api_key"],
+            http_client=anthropic.DefaultHttpxClient(http2=True),
         )
 
-        # IMAP connection
+        # Parts of every Anthropic request that only depend on the config
+        self.system_blocks = self._get_system_blocks()
+        self.max_attachment_chars = self.config.get(
+            "max_attachment_chars", MAX_ATTACHMENT_CHARS
+        )
+
+        # Optional header filter used to skip emails that aren't invoices
+        filter_pattern = self.config.get("invoice_filter_pattern")
+        self.invoice_filter = (
+            re.compile(filter_pattern, re.IGNORECASE) if filter_pattern else None
+        )
+        self.known_senders = {
+            address.lower() for address in self.config.get("known_senders") or []
+        }
+
+        # IMAP connection, and the mailbox currently selected on it
         self.mail = None
+        self.selected_mailbox = None
+
+        # SMTP connection, kept open between batches of summary emails
+        self.smtp = None
+        self.smtp_lock = threading.Lock()
+
+        # Summary emails are sent from this worker, one at a time, since they
+        # share the SMTP connection
+        self.io_pool = ThreadPoolExecutor(max_workers=1)
+        self.extraction_pool = self._create_extraction_pool()
         self.idle_event = threading.Event()
 
+    def _create_extraction_pool(self):
+        """
+        Create the worker processes shared by all analyses for slow attachment
+        text extraction. They are spawned rather than forked, as this process
+        has threads and open HTTP/2 connections by the time they start.
+        """
+        return ProcessPoolExecutor(
+            max_workers=min(os.cpu_count() or 1, PDF_MAX_WORKERS),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
     def connect_to_gmail(self):
         """Connect to Gmail via IMAP."""
         try:
@@ -76,36 +505,201 @@ class InvoiceProcessor:
             logger.error(f"Error connecting to Gmail: {e}")
             return None
 
-    def process_new_message(self, message_id):
-        """Process a single new email message."""
-        logger.info(f"Processing email ID: {message_id}")
+    def reconnect_to_gmail(self):
+        """Replace the IMAP connection with a new one, with the inbox selected."""
+        try:
+            self.mail.logout()
+        except Exception:
+            pass
+        self.mail = self.connect_to_gmail()
+        self.selected_mailbox = None
+        if self.mail:
+            self.select_inbox()
+
+    def select_inbox(self):
+        """Select the inbox, unless it is already selected on this connection."""
+        if self.selected_mailbox != "inbox":
+            status, _ = self.mail.select("inbox")
+            if status == "OK":
+                self.selected_mailbox = "inbox"
+
+    def analyze_emails(self, email_contents):
+        """
+        Analyze fetched emails with Anthropic, concurrently or as a Message
+        Batch. Returns (email_content, line_items, llm_error) tuples for the
+        emails that were analyzed.
+        """
+        for email_content in email_contents:
+            logger.info(f"Processing email ID: {email_content['id']}")
+
+        email_contents = [
+            email_content
+            for email_content in email_contents
+            if self._looks_like_invoice(email_content)
+        ]
+
+        # A lone email is analyzed straight away rather than waiting on a batch
+        max_workers = self.config.get("anthropic_max_concurrency", 4)
+        min_batch_size = self.config.get("anthropic_batch_min_emails", 2)
+        if (
+            self.config.get("anthropic_use_batches")
+            and len(email_contents) >= min_batch_size
+        ):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                is_invoice = list(
+                    executor.map(self._is_invoice_via_classifier, email_contents)
+                )
+            email_contents = [
+                email_content
+                for email_content, keep in zip(email_contents, is_invoice)
+                if keep
+            ]
+            results = self.analyze_with_batch(email_contents)
+            analyzed = [
+                (email_content, *results[email_content["id"]])
+                for email_content in email_contents
+            ]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(
+                        self.analyze_if_invoice, email_content
+                    ): email_content
+                    for email_content in email_contents
+                }
+                analyzed = []
+                for future in as_completed(futures):
+                    # One email's failure is reported in its reply rather than
+                    # stopping the rest of the batch
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error_msg = f"Error analyzing with Anthropic: {e}"
+                        logger.error(error_msg)
+                        result = [], error_msg
+                    if result is not None:
+                        analyzed.append((futures[future], *result))
+
+        return analyzed
+
+    def _is_known_sender(self, sender):
+        """Check whether a From header is one of the configured known senders."""
+        return parseaddr(sender)[1].lower() in self.known_senders
+
+    def _looks_like_invoice(self, email_content):
+        """
+        Cheap check, run before the Anthropic call, for whether a fetched email
+        could contain an invoice: its subject or sender matches the invoice
+        filter, it is from a known sender, its body mentions an invoice, or it
+        has a document attachment.
+        """
+        if not self.invoice_filter:
+            return True
+
+        if (
+            self.invoice_filter.search(email_content["subject"])
+            or self.invoice_filter.search(email_content["sender"])
+            or self._is_known_sender(email_content["sender"])
+            or INVOICE_BODY_RE.search(email_content["body"])
+        ):
+            return True
+
+        if any(
+            attachment["mime_type"] in INVOICE_ATTACHMENT_TYPES
+            for attachment in email_content["attachments"]
+        ) or email_content.get("downloaded_pdfs"):
+            return True
+
+        logger.info(
+            f"Skipping email ID {email_content['id']} ('{email_content['subject']}'): "
+            "does not look like an invoice"
+        )
+        return False
+
+    def _is_invoice_via_classifier(self, email_content):
+        """
+        Ask the cheap classifier model whether an email is an invoice or
+        statement. Returns True if no classifier is configured or it fails, so
+        uncertain emails still get the full analysis.
+        """
+        model = self.config.get("anthropic_classifier_model")
+        if not model:
+            return True
+
+        attachment_names = ", ".join(
+            attachment["filename"] for attachment in email_content["attachments"]
+        )
+        question = (
+            "Is this email a rental property invoice, bill, receipt or statement, "
+            "or does it contain one?\n\n"
+            f"EMAIL SUBJECT: {email_content['subject']}\n"
+            f"EMAIL FROM: {email_content['sender']}\n"
+            f"ATTACHMENTS: {attachment_names or 'none'}\n"
+            f"EMAIL BODY:\n{email_content['body'][:2000]}"
+        )
 
         try:
-            # Get email content
-            email_content = self.get_email_content(self.mail, message_id)
-            if not email_content:
-                return
+            response = self.anthropic_client.messages.create(
+                model=model,
+                max_tokens=5,
+                temperature=0,
+                system="Answer with only YES or NO.",
+                messages=[{"role": "user", "content": question}],
+            )
+            answer = "".join(
+                block.text for block in response.content if block.type == "text"
+            )
+        except Exception as e:
+            logger.warning(f"Invoice classifier failed, analyzing anyway: {e}")
+            return True
+
+        if answer.strip().upper().startswith("NO"):
+            logger.info(
+                f"Skipping email ID {email_content['id']} ('{email_content['subject']}'): "
+                f"classified as not an invoice by {model}"
+            )
+            return False
+        return True
 
-            # Analyze with Anthropic
-            line_items, llm_error = self.analyze_with_anthropic(email_content)
+    def analyze_if_invoice(self, email_content):
+        """
+        Analyze an email with Anthropic unless the classifier model rejects it.
+        Returns None for rejected emails.
+        """
+        if not self._is_invoice_via_classifier(email_content):
+            return None
+        return self.analyze_with_anthropic(email_content)
 
-            # Add to spreadsheet
-            added_rows, errors = self.add_to_spreadsheet(line_items)
+    def process_analyzed_emails(self, analyzed):
+        """
+        Record the analysis results of several emails, given as
+        (email_content, line_items, llm_error) tuples, with a single spreadsheet
+        append and then send a summary reply for each email.
+        """
+        if not analyzed:
+            return
 
-            # Send summary email
-            self.send_summary_email(email_content, added_rows, errors, llm_error)
+        sheet_results = self.add_to_spreadsheet(
+            [line_items for _, line_items, _ in analyzed]
+        )
 
+        # Replies are sent in the background so the IDLE loop can carry on
+        for (email_content, _, llm_error), (added_rows, errors) in zip(
+            analyzed, sheet_results
+        ):
             logger.info(f"Completed processing email ID: {email_content['id']}")
+            self.io_pool.submit(
+                self.send_summary_reply, email_content, added_rows, errors, llm_error
+            )
+
+    def send_summary_reply(self, email_content, added_rows, errors, llm_error):
+        """Send the summary reply for an email, logging rather than raising errors."""
+        logger.info(f"Sending summary for email ID: {email_content['id']}")
+        try:
+            self.send_summary_email(email_content, added_rows, errors, llm_error)
+            logger.info(f"Sent summary for email ID: {email_content['id']}")
         except Exception as e:
-            logger.error(f"Error processing message {message_id}: {e}")
-        finally:
-            # Clean up temporary attachment files
-            if 'email_content' in locals() and email_content:
-                for attachment in email_content.get("attachments", []):
-                    try:
-                        os.unlink(attachment["path"])
-                    except Exception as e:
-                        logger.error(f"Error deleting temporary file {attachment['path']}: {e}")
+            logger.error(f"Error sending summary for email {email_content['id']}: {e}")
 
     def get_unread_emails(self):
         """Retrieve unread emails from Gmail."""
@@ -113,8 +707,10 @@ class InvoiceProcessor:
             return []
 
         try:
-            self.mail.select("inbox")
-            status, messages = self.mail.search(None, "UNSEEN")
+            self.select_inbox()
+            # UIDs are used throughout, as sequence numbers shift when another
+            # client expunges messages while a batch is being processed
+            status, messages = self.mail.uid("SEARCH", None, "UNSEEN")
 
             if status != "OK":
                 logger.error("Error searching for emails")
@@ -130,62 +726,37 @@ class InvoiceProcessor:
             logger.error(f"Error retrieving emails: {e}")
             return []
 
-    def decode_email_header(self, header):
-        """Decode email header."""
-        decoded_header = decode_header(header)
-        header_parts = []
-        for content, encoding in decoded_header:
-            if isinstance(content, bytes):
-                if encoding:
-                    header_parts.append(content.decode(encoding))
-                else:
-                    header_parts.append(content.decode("utf-8", errors="replace"))
-            else:
-                header_parts.append(content)
-        return "".join(header_parts)
-
     def find_pdf_urls(self, text):
         """Find PDF URLs in email text, including HTML links."""
         urls = []
         
         # First, extract URLs from HTML href attributes
-        href_pattern = r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>([^<]*(?:\.pdf|invoice|statement|receipt|document)[^<]*)</a>'
-        html_matches = re.findall(href_pattern, text, re.IGNORECASE)
+        html_matches = HTML_DOCUMENT_LINK_RE.findall(text)
         for url, link_text in html_matches:
             logger.info(f"Found HTML link: '{link_text}' -> {url}")
             urls.append(url)
         
         # Also try to extract just href URLs without requiring specific link text
-        simple_href_pattern = r'href=["\']([^"\']+)["\']'
-        href_urls = re.findall(simple_href_pattern, text, re.IGNORECASE)
+        href_urls = HREF_RE.findall(text)
         for url in href_urls:
             # Only include if it looks like it could be a document
-            if any(keyword in url.lower() for keyword in ['document', 'statement', 'invoice', 'receipt', 'download', 'file', 'attachment']):
+            if any(keyword in url.lower() for keyword in DOCUMENT_URL_KEYWORDS):
                 logger.info(f"Found potential document URL in href: {url}")
                 urls.append(url)
         
-        # Pattern to match URLs that end with .pdf or contain pdf in the path
-        pdf_url_patterns = [
-            r'https?://[^\s<>"]+\.pdf(?:\?[^\s<>"]*)?',  # URLs ending with .pdf
-            r'https?://[^\s<>"]*[/\?&]pdf[/\?&][^\s<>"]*',  # URLs with pdf in path
-            r'https?://[^\s<>"]*(?:document|statement|invoice|receipt|download|file|attachment)[^\s<>"]*',  # Document-related URLs
-        ]
-        
-        for pattern in pdf_url_patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
+        # Match URLs that end with .pdf or contain pdf in the path
+        for pattern in PDF_URL_RES:
+            matches = pattern.findall(text)
             urls.extend(matches)
         
         # Remove duplicates while preserving order
-        unique_urls = []
-        for url in urls:
-            if url not in unique_urls:
-                unique_urls.append(url)
+        unique_urls = list(dict.fromkeys(urls))
         
         logger.info(f"All detected URLs: {unique_urls}")
         return unique_urls
 
     def download_pdf_from_url(self, url):
-        """Download PDF from URL and save to temporary file."""
+        """Download PDF from URL into memory."""
         try:
             logger.info(f"Downloading PDF from URL: {url}")
             
@@ -195,7 +766,9 @@ class InvoiceProcessor:
             }
             
             # Download the file with timeout
-            response = requests.get(url, headers=headers, timeout=30, stream=True)
+            response = self.http_session.get(
+                url, headers=headers, timeout=30, stream=True
+            )
             response.raise_for_status()
             
             # Check if the response might be a PDF (be more lenient)
@@ -206,17 +779,14 @@ class InvoiceProcessor:
             # Be more lenient - many document servers don't set correct content-type
             if 'html' in content_type and int(content_length or 0) < 10000:
                 logger.warning(f"URL {url} returned HTML content, likely not a direct document link")
+                # Release the connection back to the pool unread
+                response.close()
                 return None
             
-            # Create temporary file with .pdf extension
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            
             # Download in chunks to handle large files
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    temp_file.write(chunk)
-            
-            temp_file.close()
+            data = b"".join(
+                chunk for chunk in response.iter_content(chunk_size=8192) if chunk
+            )
             
             # Generate a filename from the URL
             parsed_url = urlparse(url)
@@ -227,7 +797,7 @@ class InvoiceProcessor:
             logger.info(f"Successfully downloaded PDF: {filename}")
             return {
                 'filename': filename,
-                'path': temp_file.name,
+                'data': data,
                 'mime_type': 'application/pdf',
                 'source_url': url
             }
@@ -239,125 +809,276 @@ class InvoiceProcessor:
             logger.error(f"Unexpected error downloading PDF from {url}: {e}")
             return None
 
-    def extract_text_from_attachment(self, file_path, mime_type):
-        """Extract text from various file types."""
+    def filter_invoice_candidates(self, mail, message_ids):
+        """
+        Fetch only the headers of the given emails and return the IDs of those
+        which may contain an invoice, so full bodies are only downloaded for them.
+        """
+        if not self.invoice_filter:
+            return message_ids
+
         try:
-            text = ""
-
-            # Process based on mime type
-            if mime_type == "application/pdf":
-                # Extract text from PDF
-                with open(file_path, "rb") as pdf_file:
-                    pdf_reader = PyPDF2.PdfReader(pdf_file)
-                    for page_num in range(len(pdf_reader.pages)):
-                        page = pdf_reader.pages[page_num]
-                        text += page.extract_text() + "\n\n"
-
-            elif (
-                mime_type
-                == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            ):
-                # Extract text from DOCX
-                doc = docx.Document(file_path)
-                for para in doc.paragraphs:
-                    text += para.text + "\n"
-
-            elif mime_type == "text/plain":
-                # Extract text from plain text file
-                with open(file_path, "r", errors="replace") as txt_file:
-                    text = txt_file.read()
-
-            elif mime_type == "text/csv":
-                # Extract text from CSV
-                with open(file_path, "r", errors="replace") as csv_file:
-                    csv_reader = csv.reader(csv_file)
-                    for row in csv_reader:
-                        text += ", ".join(row) + "\n"
-
-            elif mime_type.startswith("image/"):
-                # For images, we can't extract text directly
-                text = "[This is an image attachment]"
+            status, message_data = mail.uid(
+                "FETCH",
+                b",".join(message_ids),
+                "(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM CONTENT-TYPE)])",
+            )
+
+            if status != "OK":
+                logger.error(f"Error fetching headers for emails {message_ids}")
+                return message_ids
+        except Exception as e:
+            logger.error(f"Error fetching headers for emails {message_ids}: {e}")
+            return message_ids
+
+        candidate_ids = []
+        multipart = {}
+        unmatched = {}
+        for message_id, header_data in self._get_fetched_messages(
+            message_data, message_ids
+        ):
+            try:
+                headers = BytesParser(policy=policy.default).parsebytes(
+                    header_data, headersonly=True
+                )
+                subject = str(headers["Subject"] or "")
+                sender = str(headers["From"] or "")
+
+                # Emails with attachments are always kept, the invoice may be in them
+                matched = (
+                    self.invoice_filter.search(subject)
+                    or self.invoice_filter.search(sender)
+                    or self._is_known_sender(sender)
+                    or headers.get_content_type() == "multipart/mixed"
+                )
+                is_multipart = headers.get_content_maintype() == "multipart"
+            except Exception as e:
+                # Malformed headers are left for the full fetch to deal with
+                logger.error(
+                    f"Error reading headers of email ID {message_id.decode()}: {e}"
+                )
+                matched = True
 
+            if matched:
+                candidate_ids.append(message_id)
+            elif is_multipart:
+                multipart[message_id] = subject
+            else:
+                unmatched[message_id] = subject
+
+        # Attachments can also be nested in multipart/alternative or related
+        # parts, e.g. inline PDFs sent from Apple Mail
+        attachment_ids = (
+            self.find_emails_with_attachments(mail, list(multipart))
+            if multipart
+            else set()
+        )
+        for message_id, subject in multipart.items():
+            if attachment_ids is None or message_id in attachment_ids:
+                candidate_ids.append(message_id)
             else:
-                # For other file types
-                text = f"[Attachment of type {mime_type}]"
+                unmatched[message_id] = subject
 
-            return text
-        except Exception as e:
-            logger.error(f"Error extracting text from attachment: {e}")
-            return f"[Error extracting text: {str(e)}]"
+        # The others are kept if their body may be, or link to, an invoice
+        body_match_ids = (
+            self.search_invoice_bodies(mail, list(unmatched)) if unmatched else set()
+        )
+        for message_id, subject in unmatched.items():
+            if body_match_ids is None or message_id in body_match_ids:
+                candidate_ids.append(message_id)
+            else:
+                logger.info(
+                    f"Skipping email ID {message_id.decode()} ('{subject}'): "
+                    "does not look like an invoice"
+                )
+
+        return candidate_ids
 
-    def get_email_content(self, mail, message_id):
-        """Get the content of an email, including attachments."""
+    def find_emails_with_attachments(self, mail, message_ids):
+        """
+        Return the IDs of the given emails with a part that may hold an invoice
+        anywhere in their MIME structure, read from their IMAP BODYSTRUCTURE.
+        Returns None if it can't be fetched.
+        """
         try:
-            status, message_data = mail.fetch(message_id, "(RFC822)")
+            status, message_data = mail.uid(
+                "FETCH", b",".join(message_ids), "(BODYSTRUCTURE)"
+            )
+            if status != "OK":
+                logger.error(f"Error fetching structure of emails {message_ids}")
+                return None
+        except Exception as e:
+            logger.error(f"Error fetching structure of emails {message_ids}: {e}")
+            return None
+
+        # Each email's response starts with its sequence number. Strings sent
+        # as literals split it into several items, which are joined back up.
+        responses = []
+        for item in message_data:
+            parts = item if isinstance(item, tuple) else (item,)
+            if not isinstance(parts[0], bytes):
+                continue
+            if re.match(rb"\d+ \(", parts[0]) or not responses:
+                responses.append(b"")
+            responses[-1] += b"".join(parts)
+
+        attachment_ids = set()
+        for response in responses:
+            match = FETCH_UID_RE.search(response)
+            if match and BODYSTRUCTURE_ATTACHMENT_RE.search(response):
+                attachment_ids.add(match.group(1))
+        return attachment_ids
+
+    def search_invoice_bodies(self, mail, message_ids):
+        """
+        Return the IDs of the given emails whose body mentions an invoice or a
+        document link, found with an IMAP SEARCH on the server so the bodies
+        aren't downloaded. Returns None if the search fails. The server matches
+        more loosely than INVOICE_BODY_RE, which is checked again once emails
+        are fetched.
+        """
+        terms = list(
+            dict.fromkeys(INVOICE_BODY_TERMS + DOCUMENT_URL_KEYWORDS + ("pdf",))
+        )
+        # "OR OR a b c" matches any of a, b or c
+        criteria = "OR " * (len(terms) - 1) + " ".join(
+            f'BODY "{term}"' for term in terms
+        )
 
+        try:
+            status, data = mail.uid(
+                "SEARCH", None, "UID", b",".join(message_ids), criteria
+            )
             if status != "OK":
-                logger.error(f"Error fetching email with ID {message_id}")
+                logger.error(f"Error searching the bodies of emails {message_ids}")
                 return None
+        except Exception as e:
+            logger.error(f"Error searching the bodies of emails {message_ids}: {e}")
+            return None
 
-            raw_email = message_data[0][1]
-            email_message = email.message_from_bytes(raw_email)
+        return set((data[0] or b"").split())
 
-            # Get email headers
-            subject = self.decode_email_header(email_message["Subject"] or "No Subject")
-            sender = self.decode_email_header(email_message["From"] or "Unknown Sender")
-            date = self.decode_email_header(email_message["Date"] or "")
+    def _get_fetched_messages(self, message_data, message_ids):
+        """
+        Return (UID, data) pairs from a UID FETCH response of the given emails.
+        The response interleaves (b"<seq> (UID <uid> BODY[] {size}", data)
+        tuples with b")" terminators, but servers may send the UID after the
+        data instead, in the terminator. If neither has it, the UID requested
+        at the same position is assumed, as servers answer in mailbox order.
+        """
+        ordered_ids = sorted(message_ids, key=int)
+        fetched = []
+        for index, item in enumerate(message_data):
+            if not isinstance(item, tuple):
+                continue
+            match = FETCH_UID_RE.search(item[0])
+            following = message_data[index + 1 : index + 2]
+            if match is None and following and isinstance(following[0], bytes):
+                match = FETCH_UID_RE.search(following[0])
+
+            if match:
+                message_id = match.group(1)
+            elif len(fetched) < len(ordered_ids):
+                message_id = ordered_ids[len(fetched)]
+                logger.warning(
+                    f"No UID in FETCH response, assuming email ID {message_id.decode()}"
+                )
+            else:
+                logger.warning("No UID in FETCH response, skipping a message")
+                continue
+            fetched.append((message_id, item[1]))
+        return fetched
+
+    def get_email_contents_bulk(self, mail, message_ids):
+        """
+        Fetch several emails with a single IMAP FETCH command and parse each one.
+        Returns the parsed email contents in the order the server sent them,
+        leaving out emails that couldn't be parsed. Raises ConnectionError if
+        the FETCH fails, so the emails stay unread until after reconnecting.
+        """
+        try:
+            status, message_data = mail.uid(
+                "FETCH", b",".join(message_ids), "(BODY.PEEK[])"
+            )
+        except Exception as e:
+            raise ConnectionError(
+                f"Error fetching emails with IDs {message_ids}: {e}"
+            ) from e
+        if status != "OK":
+            raise ConnectionError(f"Error fetching emails with IDs {message_ids}")
+
+        fetched = self._get_fetched_messages(message_data, message_ids)
+
+        # Parsing is done in threads, as it also downloads any linked PDFs
+        with ThreadPoolExecutor(max_workers=EMAIL_PARSE_MAX_WORKERS) as executor:
+            email_contents = executor.map(
+                lambda fetched_email: self.get_email_content(*fetched_email), fetched
+            )
+            return [email_content for email_content in email_contents if email_content]
+
+    def _collect_message_parts(self, message, body_parts, attachments):
+        """
+        Add the plain text and HTML bodies and the attachments of a parsed email
+        to the given lists, including those of forwarded emails attached to it.
+        """
+        # Both bodies are kept, as PDF links are often only in the HTML one
+        bodies = []
+        for preference in ("plain", "html"):
+            body = message.get_body(preferencelist=(preference,))
+            if body is None:
+                continue
+            bodies.append(body)
+            try:
+                content = body.get_content()
+                body_parts.append(content)
+                logger.debug(f"Added text/{preference} content, length: {len(content)}")
+            except Exception as e:
+                logger.error(f"Error decoding email body: {e}")
+
+        # Walk every leaf part, as attachments can be nested below the body, e.g.
+        # a PDF inside multipart/mixed within multipart/alternative (Apple Mail)
+        for part in self._iter_leaf_parts(message):
+            if part.get_content_type() == "message/rfc822":
+                self._collect_message_parts(part.get_content(), body_parts, attachments)
+            elif part.get_filename() and not any(part is body for body in bodies):
+                # Keep the attachment content in memory
+                attachments.append(
+                    {
+                        "filename": part.get_filename(),
+                        "data": part.get_payload(decode=True),
+                        "mime_type": part.get_content_type(),
+                    }
+                )
+
+    def _iter_leaf_parts(self, message):
+        """
+        Yield the non-multipart parts of an email, stopping at forwarded emails so
+        that their bodies can be collected separately.
+        """
+        if not message.is_multipart():
+            return
+        for part in message.iter_parts():
+            if part.is_multipart() and part.get_content_type() != "message/rfc822":
+                yield from self._iter_leaf_parts(part)
+            else:
+                yield part
+
+    def get_email_content(self, message_id, raw_email):
+        """Get the content of a fetched email, including attachments."""
+        try:
+            email_message = BytesParser(policy=policy.default).parsebytes(raw_email)
+
+            # Get email headers, which the default policy already decodes
+            subject = str(email_message["Subject"] or "No Subject")
+            sender = str(email_message["From"] or "Unknown Sender")
+            date = str(email_message["Date"] or "")
 
             # Process email body and attachments
-            body_content = ""
+            body_parts = []
             attachments = []
             downloaded_pdfs = []
-
-            if email_message.is_multipart():
-                for part in email_message.walk():
-                    content_type = part.get_content_type()
-                    content_disposition = str(part.get("Content-Disposition"))
-
-                    if (
-                        content_type in ["text/plain", "text/html"]
-                        and "attachment" not in content_disposition
-                    ):
-                        # Get the email body (both plain text and HTML)
-                        try:
-                            body = part.get_payload(decode=True)
-                            charset = part.get_content_charset() or "utf-8"
-                            decoded_body = body.decode(charset, errors="replace")
-                            body_content += decoded_body + "\n\n"
-                            logger.debug(f"Added {content_type} content, length: {len(decoded_body)}")
-                        except Exception as e:
-                            logger.error(f"Error decoding email body: {e}")
-
-                    elif "attachment" in content_disposition or part.get_filename():
-                        # This is an attachment
-                        filename = part.get_filename()
-                        if filename:
-                            # Decode filename if needed
-                            filename = self.decode_email_header(filename)
-
-                            # Get attachment content
-                            attachment_data = part.get_payload(decode=True)
-
-                            # Save attachment to a temporary file
-                            with tempfile.NamedTemporaryFile(
-                                delete=False, suffix=os.path.splitext(filename)[1]
-                            ) as temp:
-                                temp.write(attachment_data)
-                                attachments.append(
-                                    {
-                                        "filename": filename,
-                                        "path": temp.name,
-                                        "mime_type": part.get_content_type(),
-                                    }
-                                )
-            else:
-                # Not multipart - plain text email
-                try:
-                    body = email_message.get_payload(decode=True)
-                    charset = email_message.get_content_charset() or "utf-8"
-                    body_content = body.decode(charset, errors="replace")
-                except Exception as e:
-                    logger.error(f"Error decoding email body: {e}")
+            self._collect_message_parts(email_message, body_parts, attachments)
+            body_content = "\n\n".join(body_parts)
 
             # Look for PDF URLs in the email body and download them as attachments
             if body_content:
@@ -379,9 +1100,6 @@ class InvoiceProcessor:
             else:
                 logger.warning("Email body is empty, cannot search for PDF URLs")
 
-            # Mark the message as read
-            mail.store(message_id, "+FLAGS", "\\Seen")
-
             email_data = {
                 "id": (
                     message_id.decode() if isinstance(message_id, bytes) else message_id
@@ -395,7 +1113,7 @@ class InvoiceProcessor:
             }
 
             if "References" in email_message:
-                email_data["references"] = email_message["References"]
+                email_data["references"] = str(email_message["References"])
 
             return email_data
         except Exception as e:
@@ -437,7 +1155,7 @@ class InvoiceProcessor:
         }
 
         try:
-            response = requests.get(endpoint, headers=headers, timeout=30)
+            response = self.http_session.get(endpoint, headers=headers, timeout=30)
             response.raise_for_status()
             payload = response.json()
             models = payload.get("data", [])
@@ -479,99 +1197,287 @@ class InvoiceProcessor:
             )
             return None
 
-    def _parse_anthropic_response(self, response_text):
-        """Parse Anthropic text response and extract line items as JSON."""
-        json_match = re.search(r"\[\s*\{.*?\}\s*\]", response_text, re.DOTALL)
-        if not json_match:
+    def _parse_anthropic_response(self, response):
+        """Extract line items from the record_line_items tool call in a response."""
+        tool_use = next(
+            (block for block in response.content if block.type == "tool_use"), None
+        )
+        if response.stop_reason != "tool_use" or tool_use is None:
             error_msg = (
-                f"No JSON data found in Anthropic response. Raw response: {response_text}"
+                "Anthropic did not return any line items "
+                f"(stop reason: {response.stop_reason})."
             )
             logger.error(error_msg)
             return [], error_msg
 
-        try:
-            line_items = json.loads(json_match.group(0))
-            return line_items, None
-        except json.JSONDecodeError:
-            error_msg = (
-                "Could not parse JSON from Anthropic response. "
-                f"Raw response: {response_text}"
-            )
-            logger.error(error_msg)
-            return [], error_msg
+        line_items = tool_use.input.get("line_items", [])
+        if not line_items and tool_use.input.get("notes"):
+            # Surface the model's explanation in the summary email
+            return [], tool_use.input["notes"]
+        return line_items, None
 
-    def analyze_with_anthropic(self, email_content):
-        """Send email content and attachments to Anthropic API for analysis."""
+    def _get_cache_path(self, request):
+        """
+        Return the cache file for an Anthropic request, or None if caching is
+        disabled. The key is a hash of the whole request (prompt, attachments
+        and settings) except the model, so fallback models share entries.
+        """
+        cache_dir = self.config.get("anthropic_cache_dir")
+        if not cache_dir:
+            return None
+        key = hashlib.sha256(
+            json.dumps(request, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(cache_dir, f"{key}.json")
+
+    def _read_cached_analysis(self, cache_path):
+        """Return the cached (line_items, llm_error) for a request, or None."""
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+        logger.info(f"Using cached Anthropic analysis from {cache_path}")
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        return cached["line_items"], cached["error"]
+
+    def _parse_and_cache_response(self, response, cache_path):
+        """Parse an Anthropic response and cache the result if it succeeded."""
+        line_items, llm_error = self._parse_anthropic_response(response)
+
+        if cache_path and response.stop_reason == "tool_use":
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                # Write to a temporary file first so a concurrent reader never
+                # sees a partial entry
+                tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"line_items": line_items, "error": llm_error}, f)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                logger.warning(f"Could not cache Anthropic analysis: {e}")
+
+        return line_items, llm_error
+
+    def _create_message(self, model, request, cache_path):
+        """Call Anthropic with a model and parse (and cache) the response."""
+        logger.info(f"Calling Anthropic with model: {model}")
+        response = self.anthropic_client.messages.create(model=model, **request)
+        return self._parse_and_cache_response(response, cache_path)
+
+    def _get_system_blocks(self):
+        """
+        Build the system prompt as content blocks. Everything here is identical
+        for every email, so it is marked as a prompt-cache breakpoint.
+        """
+        instructions = EXTRACTION_INSTRUCTIONS
+        additional_prompt = self.config.get("additional_prompt")
+        if additional_prompt:
+            instructions += f"\n\n{additional_prompt}"
+
+        return [
+            {"type": "text", "text": self.config["system_prompt"]},
+            {
+                "type": "text",
+                "text": instructions,
+                "cache_control": {"type": "ephemeral"},
+            },
+        ]
+
+    def _get_native_attachment_blocks(self, attachment):
+        """
+        Return the content blocks that send an attachment to Anthropic in its
+        native form (PDF document or image), or None if its text should be
+        extracted locally instead.
+        """
+        data = attachment["data"]
+        mime_type = attachment["mime_type"]
+        if not data:
+            return None
+
+        # Downloaded "PDFs" are sometimes HTML pages, so check the file header
+        if (
+            mime_type == "application/pdf"
+            and self.config.get("anthropic_native_pdfs", True)
+            and b"%PDF-" in data[:1024]
+        ):
+            page_count = count_pdf_pages(data)
+            if page_count is None or page_count > MAX_NATIVE_PDF_PAGES:
+                logger.info(
+                    f"Extracting the text of {attachment['filename']} locally, as "
+                    f"it has {page_count or 'an unknown number of'} pages"
+                )
+                return None
+            return [
+                {
+                    "type": "document",
+                    "source": {
+                        "type": "base64",
+                        "media_type": "application/pdf",
+                        "data": base64.b64encode(data).decode("ascii"),
+                    },
+                    "title": attachment["filename"],
+                }
+            ]
+
+        if mime_type in NATIVE_IMAGE_TYPES and len(data) <= MAX_NATIVE_IMAGE_BYTES:
+            return [
+                {"type": "text", "text": f"ATTACHMENT: {attachment['filename']}"},
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": mime_type,
+                        "data": base64.b64encode(data).decode("ascii"),
+                    },
+                },
+            ]
+
+        return None
+
+    def _extract_attachment_texts(self, attachments):
+        """
+        Extract the text of several attachments. When more than one of them is
+        slow to parse, they are parsed at the same time by the extraction pool.
+        Otherwise they are parsed here, with long PDFs split across the pool.
+        """
+        data = [attachment["data"] for attachment in attachments]
+        mime_types = [attachment["mime_type"] for attachment in attachments]
+        max_chars = self.max_attachment_chars
+
+        slow_count = sum(mime_type in SLOW_EXTRACTION_TYPES for mime_type in mime_types)
         try:
-            # Process and extract text from attachments
-            attachment_texts = []
-            for attachment in email_content["attachments"]:
-                try:
-                    # Extract text from the attachment
-                    extracted_text = self.extract_text_from_attachment(
-                        attachment["path"], attachment["mime_type"]
+            if slow_count > 1:
+                # Workers read long PDFs themselves, as waiting on the pool from
+                # one of its own workers could deadlock it
+                return list(
+                    self.extraction_pool.map(
+                        extract_text_from_attachment,
+                        data,
+                        mime_types,
+                        [None] * len(attachments),
+                        [max_chars] * len(attachments),
                     )
+                )
+            return [
+                extract_text_from_attachment(
+                    attachment_data,
+                    mime_type,
+                    pool=self.extraction_pool,
+                    max_chars=max_chars,
+                )
+                for attachment_data, mime_type in zip(data, mime_types)
+            ]
+        except Exception as e:
+            logger.warning(
+                f"Error extracting attachments in worker processes, retrying here: {e}"
+            )
+            # A worker that died (e.g. out of memory) leaves the pool unusable
+            if isinstance(e, BrokenProcessPool):
+                self.extraction_pool = self._create_extraction_pool()
 
-                    attachment_texts.append(
-                        {"filename": attachment["filename"], "content": extracted_text}
-                    )
+        return [
+            extract_text_from_attachment(
+                attachment_data, mime_type, max_chars=max_chars
+            )
+            for attachment_data, mime_type in zip(data, mime_types)
+        ]
 
-                    logger.info(
-                        f"Successfully extracted text from {attachment['filename']}"
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Error extracting text from {attachment['filename']}: {e}"
-                    )
-                    attachment_texts.append(
-                        {
-                            "filename": attachment["filename"],
-                            "content": f"[Error extracting content: {str(e)}]",
-                        }
-                    )
+    def _build_anthropic_request(self, email_content):
+        """
+        Build the Messages API request for an email, without the model, from
+        its content and attachments.
+        """
+        # PDFs and images are sent to Anthropic as-is, everything else is
+        # converted to text first
+        attachment_blocks = []
+        attachment_texts = []
+        max_attachment_chars = self.max_attachment_chars
+        text_attachments = []
+        native_bytes = 0
+        for attachment in email_content["attachments"]:
+            native_blocks = self._get_native_attachment_blocks(attachment)
+            if (
+                native_blocks
+                and native_bytes + len(attachment["data"]) > MAX_NATIVE_REQUEST_BYTES
+            ):
+                logger.info(
+                    f"Extracting the text of {attachment['filename']} locally, as "
+                    "sending it as-is would exceed the request size limit"
+                )
+                native_blocks = None
+            if native_blocks:
+                native_bytes += len(attachment["data"])
+                attachment_blocks.extend(native_blocks)
+                logger.info(
+                    f"Sending {attachment['filename']} to Anthropic as a "
+                    f"{native_blocks[-1]['type']} block"
+                )
+            else:
+                text_attachments.append(attachment)
 
-            # Prepare the prompt for Anthropic with email content
-            additional_prompt = self.config["additional_prompt"]
-            prompt = f"""
-I need you to analyze this email and any attachments related to rental property invoices or statements.
-Extract line items and categorize them appropriately for accounting purposes.
+        extracted_texts = self._extract_attachment_texts(text_attachments)
+        for attachment, extracted_text in zip(text_attachments, extracted_texts):
+            if len(extracted_text) > max_attachment_chars:
+                logger.warning(
+                    f"Truncating text of {attachment['filename']} from "
+                    f"{len(extracted_text)} to {max_attachment_chars} characters"
+                )
+                extracted_text = (
+                    extracted_text[:max_attachment_chars] + "\n[...truncated...]"
+                )
 
+            attachment_texts.append(
+                {"filename": attachment["filename"], "content": extracted_text}
+            )
+            logger.info(f"Extracted text from {attachment['filename']}")
+
+        # Prepare the prompt for Anthropic with email content. The static
+        # instructions live in the system prompt so they can be cached.
+        prompt_parts = [
+            f"""
 EMAIL SUBJECT: {email_content['subject']}
 EMAIL DATE: {email_content['date']}
 EMAIL BODY:
 {email_content['body']}
 
 """
+        ]
 
-            # Add attachment content to the prompt
-            for attachment in attachment_texts:
-                prompt += f"\n\nATTACHMENT: {attachment['filename']}\n"
-                prompt += f"CONTENT:\n{attachment['content']}\n"
-
-            prompt += """
-For each line item you identify, please provide:
-1. Date (in YYYY-MM-DD format)
-2. Description (what the charge or payment is for)
-3. Amount (negative for expenses, positive for income)
-4. Category (e.g., Utilities, Repairs, Rent)
-5. Property (if a specific property address is mentioned)
-
-Format your response as JSON objects in the following structure:
-[
-  {
-    "date": "YYYY-MM-DD",
-    "description": "Description of item",
-    "amount": 123.45,
-    "category": "Category",
-    "property": "Property address or empty if not specified"
-  }
-]
-"""
+        # Add attachment content to the prompt
+        for attachment in attachment_texts:
+            prompt_parts.append(
+                f"\n\nATTACHMENT: {attachment['filename']}\n"
+                f"CONTENT:\n{attachment['content']}\n"
+            )
+        prompt = "".join(prompt_parts)
+
+        # Log prompt size for debugging
+        logger.info(f"Prompt size: {len(prompt)} characters")
+
+        return {
+            "max_tokens": self.config["max_tokens"],
+            "temperature": self.config["temperature"],
+            "system": self.system_blocks,
+            "tools": [LINE_ITEMS_TOOL],
+            "tool_choice": {"type": "tool", "name": LINE_ITEMS_TOOL["name"]},
+            "messages": [
+                {
+                    "role": "user",
+                    "content": attachment_blocks + [{"type": "text", "text": prompt}],
+                }
+            ],
+        }
 
-            prompt += f"\n\n{additional_prompt}"
+    def analyze_with_anthropic(self, email_content):
+        """Send email content and attachments to Anthropic API for analysis."""
+        try:
+            request = self._build_anthropic_request(email_content)
 
-            # Log prompt size for debugging
-            logger.info(f"Prompt size: {len(prompt)} characters")
+            # Identical requests (re-sent or re-processed emails) reuse the
+            # earlier result instead of calling Anthropic again
+            cache_path = self._get_cache_path(request)
+            cached = self._read_cached_analysis(cache_path)
+            if cached:
+                return cached
 
             model_candidates = self._get_model_candidates()
             if not model_candidates:
@@ -586,15 +1492,7 @@ Format your response as JSON objects in the following structure:
             for model in model_candidates:
                 attempted_models.append(model)
                 try:
-                    logger.info(f"Calling Anthropic with model: {model}")
-                    response = self.anthropic_client.messages.create(
-                        model=model,
-                        max_tokens=self.config["max_tokens"],
-                        temperature=self.config["temperature"],
-                        system=self.config["system_prompt"],
-                        messages=[{"role": "user", "content": prompt}],
-                    )
-                    return self._parse_anthropic_response(response.content[0].text)
+                    return self._create_message(model, request, cache_path)
                 except anthropic.NotFoundError as e:
                     logger.warning(
                         f"Configured Anthropic model not found ({model}). Trying next candidate. Error: {e}"
@@ -613,15 +1511,10 @@ Format your response as JSON objects in the following structure:
                         logger.info(
                             f"Retrying with auto-discovered Anthropic model: {discovered_model}"
                         )
-                        response = self.anthropic_client.messages.create(
-                            model=discovered_model,
-                            max_tokens=self.config["max_tokens"],
-                            temperature=self.config["temperature"],
-                            system=self.config["system_prompt"],
-                            messages=[{"role": "user", "content": prompt}],
+                        return self._create_message(
+                            discovered_model, request, cache_path
                         )
-                        return self._parse_anthropic_response(response.content[0].text)
-                    except Exception as e:
+                    except anthropic.APIError as e:
                         error_msg = (
                             "Error analyzing with Anthropic after auto-discovery "
                             f"({discovered_model}): {e}"
@@ -636,59 +1529,369 @@ Format your response as JSON objects in the following structure:
             logger.error(error_msg)
             return [], error_msg
 
-        except Exception as e:
+        # API errors, and unreadable attachments or cache files
+        except (anthropic.APIError, OSError, ValueError, KeyError) as e:
             error_msg = f"Error analyzing with Anthropic: {e}"
             logger.error(error_msg)
             return [], error_msg
 
-    def add_to_spreadsheet(self, line_items):
-        """Add the analyzed line items to the Google Sheet."""
-        added_rows = []
-        errors = []
+    def _call_batches_api(self, call, *args):
+        """
+        Call the Message Batches API, retrying connection, rate limit and server
+        errors with exponential backoff.
+        """
+        delay = BATCH_POLL_INITIAL_DELAY
+        for attempt in range(BATCH_API_MAX_ATTEMPTS):
+            try:
+                return call(*args)
+            except (anthropic.APIConnectionError, anthropic.APIStatusError) as e:
+                transient = isinstance(e, anthropic.APIConnectionError) or (
+                    e.status_code == 429 or e.status_code >= 500
+                )
+                if not transient or attempt == BATCH_API_MAX_ATTEMPTS - 1:
+                    raise
+                logger.warning(
+                    f"Anthropic batch request failed, retrying in {delay} seconds: {e}"
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+
+    def _wait_for_batch(self, batch):
+        """Poll a Message Batch, backing off exponentially, until it has ended."""
+        delay = BATCH_POLL_INITIAL_DELAY
+        while batch.processing_status != "ended":
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+            batch = self._call_batches_api(
+                self.anthropic_client.messages.batches.retrieve, batch.id
+            )
+        return batch
+
+    def _get_batch_results(self, batch_id):
+        """Download the results of an ended Message Batch."""
+        return self._call_batches_api(
+            lambda: list(self.anthropic_client.messages.batches.results(batch_id))
+        )
+
+    def _get_batch_state_dir(self):
+        """Return the directory holding in-flight batch state, or None."""
+        cache_dir = self.config.get("anthropic_cache_dir")
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, "batches")
 
+    def _save_batch_state(self, batch_id, cache_paths):
+        """
+        Record a submitted batch and the cache file for each of its requests, so
+        a later run can collect its results if this one stops before it ends.
+        Returns the state file path, or None if it wasn't saved.
+        """
+        state_dir = self._get_batch_state_dir()
+        if not state_dir:
+            return None
+
+        state_path = os.path.join(state_dir, f"{batch_id}.json")
         try:
-            for item in line_items:
-                # Validate and format the data
-                try:
-                    # Convert string date to datetime object for validation
+            os.makedirs(state_dir, exist_ok=True)
+            with open(state_path, "w", encoding="utf-8") as f:
+                json.dump({"batch_id": batch_id, "cache_paths": cache_paths}, f)
+            return state_path
+        except OSError as e:
+            logger.warning(f"Could not save state of Anthropic batch {batch_id}: {e}")
+            return None
+
+    def resume_pending_batches(self):
+        """
+        Wait for batches submitted by an earlier run that stopped before they
+        ended, and cache their results.
+        """
+        state_dir = self._get_batch_state_dir()
+        if not state_dir or not os.path.isdir(state_dir):
+            return
+
+        for name in sorted(os.listdir(state_dir)):
+            if not name.endswith(".json"):
+                continue
+            state_path = os.path.join(state_dir, name)
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+
+                logger.info(f"Resuming Anthropic batch {state['batch_id']}")
+                batch = self._wait_for_batch(
+                    self._call_batches_api(
+                        self.anthropic_client.messages.batches.retrieve,
+                        state["batch_id"],
+                    )
+                )
+                for entry in self._get_batch_results(batch.id):
+                    cache_path = state["cache_paths"].get(entry.custom_id)
+                    if entry.result.type == "succeeded" and cache_path:
+                        self._parse_and_cache_response(entry.result.message, cache_path)
+
+                os.remove(state_path)
+            except anthropic.NotFoundError:
+                logger.warning(
+                    f"Anthropic batch in {state_path} no longer exists, discarding it"
+                )
+                os.remove(state_path)
+            except Exception as e:
+                logger.error(f"Error resuming Anthropic batch from {state_path}: {e}")
+
+    def analyze_with_batch(self, email_contents):
+        """
+        Analyze several emails with a single Message Batches API request, which
+        is billed at half the price of individual requests. Returns a dict of
+        email ID to (line_items, llm_error). Emails whose batch request errored
+        or expired, or that couldn't be submitted, are analyzed individually
+        instead. Raises if the results of a submitted batch can't be collected.
+        """
+        # Results of batches left unfinished, by a previous run or by an error
+        # collecting them earlier in this one, are cached first so their
+        # emails are not submitted again
+        self.resume_pending_batches()
+
+        results = {}
+        pending = {}
+        batch_requests = []
+        model_candidates = self._get_model_candidates()
+
+        for email_content in email_contents:
+            try:
+                request = self._build_anthropic_request(email_content)
+                cache_path = self._get_cache_path(request)
+                cached = self._read_cached_analysis(cache_path)
+            except Exception as e:
+                error_msg = f"Error analyzing with Anthropic: {e}"
+                logger.error(error_msg)
+                results[email_content["id"]] = [], error_msg
+                continue
+
+            if cached:
+                results[email_content["id"]] = cached
+                continue
+
+            custom_id = f"email-{email_content['id']}"
+            pending[custom_id] = email_content, cache_path
+            if model_candidates:
+                batch_requests.append(
+                    {
+                        "custom_id": custom_id,
+                        "params": {"model": model_candidates[0], **request},
+                    }
+                )
+
+        batch = None
+        if batch_requests:
+            try:
+                batch = self._call_batches_api(
+                    self.anthropic_client.messages.batches.create,
+                    batch_requests,
+                )
+            except anthropic.APIError as e:
+                logger.error(
+                    "Error submitting Anthropic batch, analyzing emails "
+                    f"individually: {e}"
+                )
+
+        if batch is not None:
+            logger.info(
+                f"Submitted Anthropic batch {batch.id} with "
+                f"{len(batch_requests)} emails"
+            )
+            state_path = self._save_batch_state(
+                batch.id,
+                {
+                    custom_id: cache_path
+                    for custom_id, (_, cache_path) in pending.items()
+                },
+            )
+
+            # Once submitted the batch is billed, so its emails aren't analyzed
+            # again if its results can't be collected. The error leaves them
+            # unread, and resume_pending_batches() caches the results once the
+            # batch can be reached again.
+            batch = self._wait_for_batch(batch)
+            for entry in self._get_batch_results(batch.id):
+                if entry.result.type != "succeeded":
+                    logger.warning(
+                        f"Anthropic batch request {entry.custom_id} "
+                        f"{entry.result.type}, analyzing it individually"
+                    )
+                    continue
+                email_content, cache_path = pending.pop(entry.custom_id)
+                results[email_content["id"]] = self._parse_and_cache_response(
+                    entry.result.message, cache_path
+                )
+
+            if state_path:
+                os.remove(state_path)
+
+        # Requests that errored, expired or couldn't be submitted go through the
+        # normal path, which also handles model fallbacks
+        for email_content, _ in pending.values():
+            try:
+                results[email_content["id"]] = self.analyze_with_anthropic(
+                    email_content
+                )
+            except Exception as e:
+                error_msg = f"Error analyzing with Anthropic: {e}"
+                logger.error(error_msg)
+                results[email_content["id"]] = [], error_msg
+
+        return results
+
+    def _validate_line_items(self, line_items):
+        """Convert an email's line items into spreadsheet rows, collecting errors."""
+        rows = []
+        errors = []
+
+        if not isinstance(line_items, list):
+            error = f"Line items are not a list: {line_items!r}"
+            logger.error(error)
+            return rows, [error]
+
+        for item in line_items:
+            # Validate and format the data
+            try:
+                if not isinstance(item, dict):
+                    raise TypeError(f"expected an object, got {type(item).__name__}")
+
+                # Validate the date. Claude almost always returns zero-padded
+                # ISO dates, which are checked without the slower strptime.
+                match = ISO_DATE_RE.fullmatch(item["date"])
+                if match:
+                    datetime.date(*map(int, match.groups()))
+                    formatted_date = item["date"]
+                else:
                     date_obj = datetime.datetime.strptime(item["date"], "%Y-%m-%d")
                     formatted_date = date_obj.strftime("%Y-%m-%d")
 
-                    # Ensure amount is a float
-                    amount = float(item["amount"])
+                # Ensure amount is a finite float, as NaN and infinity can't be
+                # sent to the Sheets API as JSON
+                amount = float(item["amount"])
+                if not math.isfinite(amount):
+                    raise ValueError(f"amount is not a finite number: {amount}")
 
-                    # Prepare row data
-                    row_data = [
-                        formatted_date,
-                        item["description"],
-                        amount,
-                        item["category"],
-                        item.get("property", ""),
-                    ]
+                # Prepare row data
+                row_data = [
+                    formatted_date,
+                    item["description"],
+                    amount,
+                    item["category"],
+                    item.get("property", ""),
+                ]
 
-                    # Add to spreadsheet
-                    self.worksheet.append_row(row_data)
-                    added_rows.append(row_data)
+                rows.append(row_data)
 
-                except (ValueError, KeyError) as e:
-                    errors.append(f"Error adding item {item}: {str(e)}")
-                    logger.error(f"Error adding item to spreadsheet: {e}")
+            except (ValueError, KeyError, TypeError) as e:
+                errors.append(f"Error adding item {item}: {str(e)}")
+                logger.error(f"Error adding item to spreadsheet: {e}")
 
-            return added_rows, errors
-        except Exception as e:
+        return rows, errors
+
+    def add_to_spreadsheet(self, line_items_per_email):
+        """
+        Add the line items of several emails to the Google Sheet in a single API
+        call. Returns an (added_rows, errors) tuple for each email.
+        """
+        results = []
+        for line_items in line_items_per_email:
+            # A malformed analysis only fails its own email
+            try:
+                results.append(self._validate_line_items(line_items))
+            except Exception as e:
+                logger.error(f"Error validating line items: {e}")
+                results.append(([], [f"Error validating line items: {str(e)}"]))
+        rows = [row for email_rows, _ in results for row in email_rows]
+        if not rows:
+            return results
+
+        try:
+            self._append_rows(rows)
+            return results
+        except (
+            gspread.exceptions.APIError,
+            requests.exceptions.RequestException,
+            GoogleAuthError,
+        ) as e:
             logger.error(f"Error updating spreadsheet: {e}")
-            return added_rows, [f"General error updating spreadsheet: {str(e)}"]
+            general_error = f"General error updating spreadsheet: {str(e)}"
+            return [
+                ([], errors + [general_error] if email_rows else errors)
+                for email_rows, errors in results
+            ]
+
+    def _append_rows(self, rows):
+        """Append rows to the worksheet, backing off when rate limited."""
+        for attempt in range(SHEETS_MAX_ATTEMPTS):
+            try:
+                self.spreadsheet.values_append(
+                    self.append_range,
+                    params={
+                        "valueInputOption": "USER_ENTERED",
+                        "insertDataOption": "INSERT_ROWS",
+                    },
+                    body={"values": rows},
+                )
+                return
+            except gspread.exceptions.APIError as e:
+                if (
+                    e.response.status_code != 429
+                    or attempt == SHEETS_MAX_ATTEMPTS - 1
+                ):
+                    raise
+                delay = 2 ** (attempt + 1)
+                logger.warning(
+                    f"Google Sheets rate limit hit, retrying in {delay} seconds..."
+                )
+                time.sleep(delay)
+
+    def connect_to_smtp(self):
+        """Open an authenticated SMTP connection for sending summary emails."""
+        server = smtplib.SMTP(
+            self.config["gmail_smtp_server"], self.config["gmail_smtp_port"]
+        )
+        server.starttls()
+        server.login(self.config["gmail_email"], self.config["gmail_app_password"])
+        return server
+
+    def send_smtp_message(self, msg):
+        """
+        Send a message over the persistent SMTP connection, opening it on first
+        use and reconnecting if the server has dropped it while idle.
+        """
+        with self.smtp_lock:
+            if self.smtp:
+                try:
+                    alive = self.smtp.noop()[0] == 250
+                except (smtplib.SMTPException, OSError):
+                    alive = False
+                if not alive:
+                    logger.warning("SMTP connection lost, reconnecting...")
+                    self.close_smtp()
+
+            if not self.smtp:
+                self.smtp = self.connect_to_smtp()
+
+            self.smtp.sendmail(
+                self.config["gmail_email"],
+                self.config["forwarding_email"],
+                msg.as_string(),
+            )
+
+    def close_smtp(self):
+        """Close the shared SMTP connection if it exists."""
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass  # Ignore errors during cleanup
+            self.smtp = None
 
     def send_summary_email(self, email_data, added_rows, errors, llm_error=None):
         """Send a summary email with the results."""
         try:
-            # Set up SMTP connection
-            server = smtplib.SMTP(
-                self.config["gmail_smtp_server"], self.config["gmail_smtp_port"]
-            )
-            server.starttls()
-            server.login(self.config["gmail_email"], self.config["gmail_app_password"])
-
             msg = MIMEMultipart()
             msg["To"] = self.config["forwarding_email"]
             msg["From"] = self.config["gmail_email"]
@@ -702,42 +1905,57 @@ Format your response as JSON objects in the following structure:
             else:
                 msg["References"] = email_data["id"]
 
-            email_body = f"""
+            # Collect the HTML fragments and join them once at the end
+            body_parts = [
+                """
             <html>
             <body>
             """
+            ]
 
             if added_rows:
-                email_body += f"""
-                <h3>👍 Added to the <a href="https://docs.google.com/spreadsheets/d/{self.config["spreadsheet_id"]}">Google Sheet<a> ('{self.config["worksheet_name"]}' worksheet)</h3>
+                body_parts.append(
+                    f"""
+                <h3>👍 Added to the <a href="https://docs.google.com/spreadsheets/d/{self.config["spreadsheet_id"]}">Google Sheet<a> ('{html.escape(self.config["worksheet_name"])}' worksheet)</h3>
                 """
-                email_body += "<table border='1' cellpadding='5'>"
-                email_body += "<tr><th>Date</th><th>Description</th><th>Amount</th>\
-                    <th>Category</th><th>Property</th></tr>"
-
-                for row in added_rows:
-                    email_body += f"<tr><td>{row[0]}</td><td>{row[1]}</td>\
-                        <td>{row[2]}</td><td>{row[3]}</td><td>{row[4]}</td></tr>"
+                )
+                body_parts.append("<table border='1' cellpadding='5'>")
+                body_parts.append("<tr><th>Date</th><th>Description</th><th>Amount</th>\
+                    <th>Category</th><th>Property</th></tr>")
+
+                # Line items come from the email, so escape them before
+                # putting them in the HTML
+                body_parts.append(
+                    "".join(
+                        "<tr>"
+                        + "".join(f"<td>{html.escape(str(value))}</td>" for value in row)
+                        + "</tr>"
+                        for row in added_rows
+                    )
+                )
 
-                email_body += "</table>"
+                body_parts.append("</table>")
             else:
-                email_body += "<p>🤔 No items were processed.</p>"
+                body_parts.append("<p>🤔 No items were processed.</p>")
                 
                 # Add LLM error message if there was one
                 if llm_error:
-                    email_body += "<h3>📝 Response from LLM:</h3>"
-                    email_body += f"<pre style='background-color: #f5f5f5; padding: 10px; border-radius: 5px; white-space: pre-wrap;'>{llm_error}</pre>"
+                    body_parts.append("<h3>📝 Response from LLM:</h3>")
+                    body_parts.append(f"<pre style='background-color: #f5f5f5; padding: 10px; border-radius: 5px; white-space: pre-wrap;'>{html.escape(llm_error)}</pre>")
 
             if errors:
-                email_body += "<h2>🚨 Errors:</h2><ul>"
-                for error in errors:
-                    email_body += f"<li>{error}</li>"
-                email_body += "</ul>"
+                body_parts.append("<h2>🚨 Errors:</h2><ul>")
+                body_parts.extend(f"<li>{html.escape(error)}</li>" for error in errors)
+                body_parts.append("</ul>")
 
-            email_body += """
+            body_parts.append(
+                """
             </body>
             </html>
             """
+            )
+
+            email_body = "".join(body_parts)
 
             msg.attach(MIMEText(email_body, "html"))
 
@@ -747,30 +1965,44 @@ Format your response as JSON objects in the following structure:
                 logger.info(f"Attaching {len(downloaded_pdfs)} downloaded PDFs to reply email")
                 for pdf in downloaded_pdfs:
                     try:
-                        with open(pdf["path"], "rb") as f:
-                            pdf_attachment = MIMEApplication(f.read(), _subtype="pdf")
-                            pdf_attachment.add_header(
-                                "Content-Disposition", 
-                                f"attachment; filename={pdf['filename']}"
-                            )
-                            msg.attach(pdf_attachment)
-                            logger.info(f"Attached PDF: {pdf['filename']}")
+                        pdf_attachment = MIMEApplication(pdf["data"], _subtype="pdf")
+                        pdf_attachment.add_header(
+                            "Content-Disposition", 
+                            f"attachment; filename={pdf['filename']}"
+                        )
+                        msg.attach(pdf_attachment)
+                        logger.info(f"Attached PDF: {pdf['filename']}")
                     except Exception as e:
                         logger.error(f"Error attaching PDF {pdf['filename']}: {e}")
 
             # Send the message
-            server.sendmail(
-                self.config["gmail_email"],
-                self.config["forwarding_email"],
-                msg.as_string(),
-            )
-            server.quit()
+            self.send_smtp_message(msg)
 
             logger.info(f"Summary email sent to {self.config['forwarding_email']}")
 
         except Exception as e:
             logger.error(f"Error sending summary email: {e}")
 
+    def mark_as_seen(self, message_ids):
+        """
+        Mark a batch of emails as read with a single IMAP UID STORE command.
+        The server may have dropped the connection while the emails were
+        analyzed (a Message Batch can take hours), so on failure it reconnects
+        and tries once more. Returns whether the emails were marked.
+        """
+        for attempt in range(2):
+            try:
+                status, _ = self.mail.uid(
+                    "STORE", b",".join(message_ids), "+FLAGS", "\\Seen"
+                )
+                return status == "OK"
+            except Exception as e:
+                logger.error(f"Error marking emails {message_ids} as read: {e}")
+            if attempt == 0:
+                logger.info("Reconnecting to Gmail to mark emails as read...")
+                self.reconnect_to_gmail()
+        return False
+
     def process_pending_emails(self):
         """Process any pending unread emails."""
         message_ids = self.get_unread_emails()
@@ -778,8 +2010,33 @@ Format your response as JSON objects in the following structure:
         if not message_ids:
             return
 
-        for message_id in message_ids:
-            self.process_new_message(message_id)
+        for start in range(0, len(message_ids), IMAP_FETCH_BATCH_SIZE):
+            batch_ids = message_ids[start : start + IMAP_FETCH_BATCH_SIZE]
+            candidate_ids = self.filter_invoice_candidates(self.mail, batch_ids)
+            email_contents = []
+            analyzed = []
+            if candidate_ids:
+                email_contents = self.get_email_contents_bulk(self.mail, candidate_ids)
+                analyzed = self.analyze_emails(email_contents)
+
+            # Skipped emails are marked as read too, so they aren't triaged
+            # again. Emails that couldn't be fetched or parsed stay unread.
+            candidate_set = set(candidate_ids)
+            seen_ids = [
+                message_id
+                for message_id in batch_ids
+                if message_id not in candidate_set
+            ] + [email_content["id"].encode() for email_content in email_contents]
+
+            # Emails are marked as read before their line items are recorded.
+            # If that fails they stay unread, to be recorded after reconnecting
+            # (from the analysis cache, if enabled) rather than recorded twice.
+            if seen_ids and not self.mark_as_seen(seen_ids):
+                raise ConnectionError(
+                    f"Could not mark emails {seen_ids} as read, "
+                    "leaving them unread to record later"
+                )
+            self.process_analyzed_emails(analyzed)
 
     def idle_callback(self, args):
         """Callback function for IMAP IDLE events."""
@@ -796,6 +2053,11 @@ Format your response as JSON objects in the following structure:
         """
         reconnect_attempts = 0
 
+        # Collect the results of Message Batches left unfinished by a previous
+        # run before any emails are analyzed, so their emails are not billed
+        # again when they are re-fetched
+        self.resume_pending_batches()
+
         while reconnect_attempts < self.config["max_reconnect_attempts"]:
             try:
                 # Connect to Gmail
@@ -812,7 +2074,8 @@ Format your response as JSON objects in the following structure:
                 reconnect_attempts = 0
 
                 # Select the inbox
-                self.mail.select("inbox")
+                self.selected_mailbox = None
+                self.select_inbox()
 
                 # Process any existing unread emails first
                 self.process_pending_emails()
@@ -828,16 +2091,11 @@ Format your response as JSON objects in the following structure:
                         callback=self.idle_callback, timeout=self.config["idle_timeout"]
                     )
 
-                    # Process new emails if the callback was triggered
+                    # Process new emails if the callback was triggered. A
+                    # dropped connection makes the next idle() call raise,
+                    # which reconnects below.
                     self.process_pending_emails()
 
-                    # Keep connection alive with NOOP
-                    status, data = self.mail.noop()
-                    if status != "OK":
-                        logger.warning("NOOP failed, reconnecting...")
-                        self.cleanup_connection()
-                        break
-
             except Exception as e:
                 logger.error(f"Unexpected error in IDLE loop: {e}")
                 self.cleanup_connection()
@@ -848,8 +2106,16 @@ Format your response as JSON objects in the following structure:
             f"Failed to reconnect after {self.config['max_reconnect_attempts']} attempts. Exiting."
         )
 
+    def shutdown(self):
+        """Wait for queued summary emails to be sent, then close connections."""
+        self.io_pool.shutdown(wait=True)
+        self.extraction_pool.shutdown()
+        self.cleanup_connection()
+
     def cleanup_connection(self):
-        """Clean up IMAP connection if it exists."""
+        """Clean up the IMAP and SMTP connections if they exist."""
+        with self.smtp_lock:
+            self.close_smtp()
         if self.mail:
             try:
                 self.mail.close()
@@ -857,6 +2123,7 @@ Format your response as JSON objects in the following structure:
             except:
                 pass  # Ignore errors during cleanup
             self.mail = None
+            self.selected_mailbox = None
 
 
 if __name__ == "__main__":
@@ -867,8 +2134,8 @@ if __name__ == "__main__":
         processor.listen_for_emails()
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt, shutting down...")
-        processor.cleanup_connection()
+        processor.shutdown()
         logger.info("Invoice Processor shut down gracefully")
     except Exception as e:
         logger.critical(f"Fatal error: {e}")
-        processor.cleanup_connection()
+        processor.shutdown()